@@ -0,0 +1,34 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from _db import DB_POOL_SIZE, Database
+from settings import CONFIG
+
+# Threads running blocking DB calls for the event loop; more than the pool
+# size would only queue on checkout
+DB_EXECUTOR_WORKERS = getattr(CONFIG, "DB_EXECUTOR_WORKERS", DB_POOL_SIZE)
+
+
+class AsyncDatabase:
+    # Runs blocking Database (or Soap2day) calls off the event loop
+    def __init__(
+        self, database: Database, max_workers: int = DB_EXECUTOR_WORKERS
+    ) -> None:
+        self.database = database
+        self.max_workers = max(1, max_workers)
+        self._executor = None
+
+    async def run(self, func, *args, **kwargs):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="db"
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(func, *args, **kwargs)
+        )
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
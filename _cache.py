@@ -0,0 +1,75 @@
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = max(1, maxsize)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class KnownIds:
+    # Sorted arrays of TMDB ids per movie type; 4 bytes per id
+    def __init__(self) -> None:
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def load(self, movie_type: str, ids: list) -> None:
+        with self._lock:
+            self._ids[movie_type] = array("I", sorted(set(ids)))
+
+    def update(self, movie_type: str, ids: list) -> None:
+        # Merges ids into the loaded set instead of replacing it
+        with self._lock:
+            merged = set(self._ids.get(movie_type, ())).union(ids)
+            self._ids[movie_type] = array("I", sorted(merged))
+
+    def add(self, movie_type: str, tmdb_id: int) -> None:
+        with self._lock:
+            ids = self._ids.setdefault(movie_type, array("I"))
+            i = bisect_left(ids, tmdb_id)
+            if i == len(ids) or ids[i] != tmdb_id:
+                ids.insert(i, tmdb_id)
+
+    def contains(self, movie_type: str, tmdb_id: int) -> bool:
+        with self._lock:
+            ids = self._ids.get(movie_type, ())
+            i = bisect_left(ids, tmdb_id)
+            return i < len(ids) and ids[i] == tmdb_id
+
+    def count(self, movie_type: str) -> int:
+        with self._lock:
+            return len(self._ids.get(movie_type, ()))
@@ -1,92 +1,371 @@
-import sys
+import queue
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import mysql.connector
+from mysql.connector.errors import PoolError
 
 from settings import CONFIG
 
+DB_POOL_SIZE = getattr(CONFIG, "DB_POOL_SIZE", 5)
+DB_POOL_TIMEOUT = getattr(CONFIG, "DB_POOL_TIMEOUT", 30)
+# Connections idle for longer than this are pinged (and reconnected) on checkout
+DB_POOL_PING_AFTER = getattr(CONFIG, "DB_POOL_PING_AFTER", 60)
+# Parameterized queries run as server-side prepared statements, one per query
+# shape and connection. Off by default: mysql-connector sends COM_STMT_RESET
+# before every prepared execute, so each query costs two round trips instead
+# of one; only worth it where parsing dominates the network
+DB_PREPARED_STATEMENTS = getattr(CONFIG, "DB_PREPARED_STATEMENTS", False)
+DB_PREPARED_CACHE_SIZE = getattr(CONFIG, "DB_PREPARED_CACHE_SIZE", 64)
+# IN lists get a new shape per length; preparing them would churn the cache
+VARIABLE_IN_LIST = re.compile(r"\bIN \((?:%s, )*%s\)", re.IGNORECASE)
+
 
 class Database:
-    def __init__(self) -> None:
-        self.conn = self.get_conn()
+    def __init__(self, pool_size: int = DB_POOL_SIZE) -> None:
+        self.pool_size = max(1, pool_size)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        # conn -> {query: (query, prepared cursor)}
+        self._prepared = weakref.WeakKeyDictionary()
+        # Connection pinned to the thread by transaction() / group_commit()
+        self._local = threading.local()
+
+    def connect(self):
+        return mysql.connector.connect(
+            user=CONFIG.user,
+            password=CONFIG.password,
+            host=CONFIG.host,
+            port=CONFIG.port,
+            database=CONFIG.database,
+            # Standalone statements commit themselves, so a connection that
+            # only read has nothing to roll back on release; transaction()
+            # opens one explicitly
+            autocommit=True,
+        )
+
+    def _open_conn(self):
+        with self._lock:
+            if self._opened >= self.pool_size:
+                return None
+            self._opened += 1
 
-    def get_conn(self):
+        # Opened lazily mid-run, possibly on a worker thread: a failure must
+        # surface as an error the caller can retry, not SystemExit
         try:
-            return mysql.connector.connect(
-                user=CONFIG.user,
-                password=CONFIG.password,
-                host=CONFIG.host,
-                port=CONFIG.port,
-                database=CONFIG.database,
-            )
-        except Exception as e:
+            return self.connect()
+        except BaseException as e:
             print(f"Error connecting to MariaDB Platform: {e}")
-            sys.exit(1)
+            self._discard(None)
+            raise
+
+    def _discard(self, conn) -> None:
+        with self._lock:
+            self._opened -= 1
+        if conn is not None:
+            self._forget_prepared(conn)
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def checkout(self, timeout: float = DB_POOL_TIMEOUT):
+        while True:
+            try:
+                conn, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open_conn()
+                if conn is not None:
+                    return conn
+                try:
+                    conn, released_at = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise PoolError(
+                        f"No database connection available after {timeout}s"
+                    )
+
+            if time.monotonic() - released_at < DB_POOL_PING_AFTER:
+                return conn
+
+            try:
+                # A reconnect drops the server-side statements
+                self._forget_prepared(conn)
+                conn.ping(reconnect=True, attempts=3, delay=1)
+                return conn
+            except Exception as e:
+                print(f"Dropping dead MariaDB connection: {e}")
+                self._discard(conn)
+
+    def release(self, conn) -> None:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+
+        self._idle.put((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        pinned = getattr(self._local, "conn", None)
+        if pinned is not None:
+            yield pinned
+            return
+
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def in_transaction(self) -> bool:
+        return getattr(self._local, "conn", None) is not None
 
-    def select_with(self, query: str) -> list:
-        conn = self.conn
+    def commit(self, conn) -> None:
+        # Inside transaction() only the outermost scope commits
+        if conn is not getattr(self._local, "conn", None) and conn.in_transaction:
+            conn.commit()
+
+    def _run(self, conn, query: str) -> None:
         cur = conn.cursor()
         cur.execute(query)
-        res = cur.fetchall()
         cur.close()
-        # conn.close()
 
-        return res
+    @contextmanager
+    def _pin(self, group_size: int):
+        conn = self.checkout()
+        self._local.conn = conn
+        self._local.depth = 0
+        self._local.group_size = group_size
+        self._local.pending = 0
+        try:
+            conn.start_transaction()
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self.release(conn)
 
-    def select_all_from(self, table: str, condition: str = "1=1", cols: str = "*"):
-        conn = self.conn
-        cur = conn.cursor()
-        cur.execute(
-            f"SELECT {cols} FROM {CONFIG.TABLE_PREFIX}{table} WHERE {condition}"
-        )
-        res = cur.fetchall()
-        cur.close()
-        # conn.close()
+    @contextmanager
+    def transaction(self):
+        if getattr(self._local, "conn", None) is None:
+            with self._pin(group_size=1):
+                with self.transaction() as conn:
+                    yield conn
+            return
+
+        # Nested scopes (and titles inside a group) roll back to a savepoint
+        conn = self._local.conn
+        self._local.depth += 1
+        savepoint = f"sp_{self._local.depth}"
+        self._run(conn, f"SAVEPOINT {savepoint}")
+        try:
+            yield conn
+        except BaseException:
+            self._run(conn, f"ROLLBACK TO SAVEPOINT {savepoint}")
+            raise
+        else:
+            self._run(conn, f"RELEASE SAVEPOINT {savepoint}")
+        finally:
+            self._local.depth -= 1
+
+        if self._local.depth == 0:
+            self._local.pending += 1
+            if self._local.pending >= self._local.group_size:
+                conn.commit()
+                conn.start_transaction()
+                self._local.pending = 0
+
+    @contextmanager
+    def group_commit(self, size: int):
+        # Commit once every `size` top-level transactions instead of each one
+        if getattr(self._local, "conn", None) is not None:
+            yield self._local.conn
+            return
+
+        with self._pin(group_size=max(1, size)) as conn:
+            yield conn
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def _forget_prepared(self, conn) -> None:
+        with self._lock:
+            statements = self._prepared.pop(conn, {})
+        for _, cur in statements.values():
+            try:
+                cur.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def cursor_for(self, conn, query: str, data: tuple = ()):
+        if not DB_PREPARED_STATEMENTS or not data or VARIABLE_IN_LIST.search(query):
+            cur = conn.cursor()
+            try:
+                cur.execute(query, data or None)
+                yield cur
+            finally:
+                cur.close()
+            return
+
+        with self._lock:
+            statements = self._prepared.setdefault(conn, OrderedDict())
+
+        # The cursor re-prepares whenever it is handed a different str object,
+        # so always pass the one it was prepared with
+        query, cur = statements.get(query, (query, None))
+        if cur is None:
+            if len(statements) >= DB_PREPARED_CACHE_SIZE:
+                _, (_, evicted) = statements.popitem(last=False)
+                try:
+                    evicted.close()
+                except Exception:
+                    pass
+            cur = conn.cursor(prepared=True)
+            statements[query] = (query, cur)
+        else:
+            statements.move_to_end(query)
+
+        try:
+            cur.execute(query, tuple(data))
+            yield cur
+        except Exception:
+            statements.pop(query, None)
+            try:
+                cur.close()
+            except Exception:
+                pass
+            raise
+
+    def get_where(self, where: dict) -> tuple:
+        if not where:
+            return "1=1", ()
+        return " AND ".join(f"{col}=%s" for col in where), tuple(where.values())
+
+    def select_with(self, query: str, data: tuple = ()) -> list:
+        with self.connection() as conn:
+            with self.cursor_for(conn, query, data) as cur:
+                res = cur.fetchall()
 
         return res
 
-    def insert_into(self, table: str, data: tuple = None, is_bulk: bool = False):
-        conn = self.conn
-        cur = conn.cursor()
+    def select_all_from(
+        self,
+        table: str,
+        condition: str = "1=1",
+        cols: str = "*",
+        data: tuple = (),
+        where: dict = None,
+    ):
+        if where:
+            condition, data = self.get_where(where)
+
+        return self.select_with(
+            f"SELECT {cols} FROM {CONFIG.TABLE_PREFIX}{table} WHERE {condition}", data
+        )
+
+    def insert_into(
+        self,
+        table: str,
+        data: tuple = None,
+        is_bulk: bool = False,
+        ignore: bool = False,
+    ):
         id = 0
 
         columns = f"({', '.join(CONFIG.INSERT[table])})"
         values = f"({', '.join(['%s'] * len(CONFIG.INSERT[table]))})"
-        query = f"INSERT INTO {CONFIG.TABLE_PREFIX}{table} {columns} VALUES {values}"
-        if is_bulk:
-            cur.executemany(query, data)
-        else:
-            cur.execute(query, data)
-            id = cur.lastrowid
+        insert = "INSERT IGNORE" if ignore else "INSERT"
+        query = f"{insert} INTO {CONFIG.TABLE_PREFIX}{table} {columns} VALUES {values}"
+        with self.connection() as conn:
+            if is_bulk:
+                # Plain cursor: it rewrites the batch into one multi-row INSERT
+                cur = conn.cursor()
+                cur.executemany(query, data)
+                cur.close()
+            else:
+                with self.cursor_for(conn, query, data) as cur:
+                    id = cur.lastrowid
 
-        conn.commit()
-        cur.close()
-        # conn.close()
+            self.commit(conn)
+        return id
+
+    def upsert(self, table: str, data: tuple, update_cols: tuple = ()) -> int:
+        # One round trip instead of select_or_insert; needs a unique key on the
+        # lookup columns. LAST_INSERT_ID(id) makes lastrowid the existing row's
+        # id when the insert hits a duplicate.
+        columns = f"({', '.join(CONFIG.INSERT[table])})"
+        values = f"({', '.join(['%s'] * len(CONFIG.INSERT[table]))})"
+        updates = ", ".join(
+            ["id=LAST_INSERT_ID(id)", *[f"{col}=VALUES({col})" for col in update_cols]]
+        )
+        query = (
+            f"INSERT INTO {CONFIG.TABLE_PREFIX}{table} {columns} VALUES {values}"
+            f" ON DUPLICATE KEY UPDATE {updates}"
+        )
+        with self.connection() as conn:
+            with self.cursor_for(conn, query, data) as cur:
+                id = cur.lastrowid
+            self.commit(conn)
         return id
 
     def update_table(
-        self, table: str, set_cond: str, where_cond: str, data: tuple = ()
+        self,
+        table: str,
+        set_cond: str = "",
+        where_cond: str = "1=1",
+        data: tuple = (),
+        values: dict = None,
+        where: dict = None,
     ):
-        conn = self.conn
-        cur = conn.cursor()
-        cur.execute(
+        if values:
+            set_cond = ", ".join(f"{col}=%s" for col in values)
+            data = tuple(values.values())
+        if where:
+            where_cond, where_data = self.get_where(where)
+            data = (*data, *where_data)
+
+        self.execute(
             f"UPDATE {CONFIG.TABLE_PREFIX}{table} set {set_cond} WHERE {where_cond}",
             data,
         )
-        conn.commit()
-        cur.close()
-        # conn.close()
 
-    def delete_from(self, table: str = "", condition: str = "1=1"):
-        conn = self.conn
-        cur = conn.cursor()
-        cur.execute(f"DELETE FROM {CONFIG.TABLE_PREFIX}{table} WHERE {condition}")
-        conn.commit()
-        cur.close()
-        # conn.close()
+    def delete_from(self, table: str = "", condition: str = "1=1", where: dict = None):
+        data = ()
+        if where:
+            condition, data = self.get_where(where)
 
-    def select_or_insert(self, table: str, condition: str, data: tuple):
-        res = self.select_all_from(table=table, condition=condition)
+        self.execute(
+            f"DELETE FROM {CONFIG.TABLE_PREFIX}{table} WHERE {condition}", data
+        )
+
+    def execute(self, query: str, data: tuple = ()) -> int:
+        with self.connection() as conn:
+            with self.cursor_for(conn, query, data) as cur:
+                rowcount = cur.rowcount
+            self.commit(conn)
+        return rowcount
+
+    def select_or_insert(
+        self, table: str, condition: str = "1=1", data: tuple = (), where: dict = None
+    ):
+        res = self.select_all_from(table=table, condition=condition, where=where)
         if not res:
             self.insert_into(table, data)
-            res = self.select_all_from(table, condition=condition)
+            res = self.select_all_from(table, condition=condition, where=where)
         return res
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import socket
+from contextlib import asynccontextmanager
+
+from _db import Database
+from settings import CONFIG
+
+CRAWL_LEASES = getattr(CONFIG, "CRAWL_LEASES", False)
+# A node that stops heartbeating loses its leases after this many seconds
+CRAWL_LEASE_TTL = getattr(CONFIG, "CRAWL_LEASE_TTL", 300)
+# Finished work stays leased this long so other nodes skip it in the same pass
+CRAWL_LEASE_DONE_TTL = getattr(CONFIG, "CRAWL_LEASE_DONE_TTL", 6 * 3600)
+
+
+class LeaseManager:
+    def __init__(
+        self,
+        database: Database,
+        owner: str = "",
+        ttl: int = CRAWL_LEASE_TTL,
+        done_ttl: int = CRAWL_LEASE_DONE_TTL,
+    ) -> None:
+        self.database = database
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self.done_ttl = done_ttl
+        self.table = f"{CONFIG.TABLE_PREFIX}crawl_lease"
+
+    def claim(self, key: str) -> bool:
+        # Both statements are atomic on the row, so only one node can win
+        if self.database.execute(
+            f"INSERT IGNORE INTO {self.table} (lease_key, owner, expires_at)"
+            " VALUES (%s, %s, NOW() + INTERVAL %s SECOND)",
+            (key, self.owner, self.ttl),
+        ):
+            return True
+
+        return (
+            self.database.execute(
+                f"UPDATE {self.table}"
+                " SET owner = %s, expires_at = NOW() + INTERVAL %s SECOND"
+                " WHERE lease_key = %s AND expires_at < NOW()",
+                (self.owner, self.ttl, key),
+            )
+            > 0
+        )
+
+    def get_owner(self, key: str) -> str:
+        rows = self.database.select_with(
+            f"SELECT owner FROM {self.table} WHERE lease_key = %s", (key,)
+        )
+        return rows[0][0] if rows else ""
+
+    def renew(self, key: str) -> bool:
+        return (
+            self.database.execute(
+                f"UPDATE {self.table} SET expires_at = NOW() + INTERVAL %s SECOND"
+                " WHERE lease_key = %s AND owner = %s",
+                (self.ttl, key, self.owner),
+            )
+            > 0
+        )
+
+    def release(self, key: str, done: bool = True) -> None:
+        # Unfinished work is handed back straight away
+        self.database.execute(
+            f"UPDATE {self.table} SET expires_at = NOW() + INTERVAL %s SECOND"
+            " WHERE lease_key = %s AND owner = %s",
+            (self.done_ttl if done else 0, key, self.owner),
+        )
+
+    def purge_expired(self) -> int:
+        return self.database.execute(
+            f"DELETE FROM {self.table} WHERE expires_at < NOW() - INTERVAL %s SECOND",
+            (self.done_ttl,),
+        )
+
+    async def heartbeat(self, key: str, run) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await run(self.renew, key):
+                    print(f"[!] Lost lease {key}")
+                    return
+            except Exception as e:
+                print(f"[!] Failed to renew lease {key}: {e}")
+
+    @asynccontextmanager
+    async def hold(self, key: str, run=asyncio.to_thread):
+        # `run` executes the blocking DB calls off the loop thread, which may
+        # have a group-commit connection pinned
+        task = asyncio.create_task(self.heartbeat(key, run))
+        done = False
+        try:
+            yield
+            done = True
+        finally:
+            task.cancel()
+            await run(self.release, key, done=done)
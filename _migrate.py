@@ -0,0 +1,138 @@
+import argparse
+
+from _db import Database
+from _schema import (
+    LOOKUP_INDEXES,
+    LOOKUP_QUERIES,
+    column_name,
+    find_covering_index,
+    get_indexes,
+)
+from settings import CONFIG
+
+database = Database()
+
+
+def table_exists(table: str) -> bool:
+    return bool(
+        database.select_with(
+            "SELECT 1 FROM information_schema.TABLES"
+            " WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s",
+            (f"{CONFIG.TABLE_PREFIX}{table}",),
+        )
+    )
+
+
+def find_duplicate_indexes(indexes: dict) -> list:
+    # An index whose columns are a left prefix of another one is redundant,
+    # unless it is the unique key
+    duplicates = []
+    for name, (columns, unique) in indexes.items():
+        if unique:
+            continue
+        for other, (other_columns, _) in indexes.items():
+            if other_columns[: len(columns)] != columns or other == name:
+                continue
+            if len(other_columns) > len(columns) or other < name:
+                duplicates.append((name, other))
+                break
+    return duplicates
+
+
+def count_duplicate_rows(table: str, columns: tuple) -> int:
+    cols = ", ".join(columns)
+    return len(
+        database.select_with(
+            f"SELECT {cols} FROM {CONFIG.TABLE_PREFIX}{table}"
+            f" GROUP BY {cols} HAVING COUNT(*) > 1"
+        )
+    )
+
+
+def explain_queries(tables: set) -> None:
+    for query, data in LOOKUP_QUERIES:
+        query = query.format(prefix=CONFIG.TABLE_PREFIX)
+        if not any(f"{CONFIG.TABLE_PREFIX}{table} " in query for table in tables):
+            continue
+
+        with database.connection() as conn:
+            cur = conn.cursor(dictionary=True)
+            cur.execute(f"EXPLAIN {query}", data)
+            plans = cur.fetchall()
+            cur.close()
+
+        print(f"    {query}")
+        for plan in plans:
+            print(
+                f"        type={plan.get('type')} key={plan.get('key')}"
+                f" rows={plan.get('rows')} extra={plan.get('Extra') or ''}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report and create the indexes the crawler's lookups need"
+    )
+    parser.add_argument(
+        "--apply", action="store_true", help="create missing indexes (default: report)"
+    )
+    args = parser.parse_args()
+
+    tables = set()
+    missing = []
+    for table, name, columns, unique in LOOKUP_INDEXES:
+        if not table_exists(table):
+            print(f"[!] {CONFIG.TABLE_PREFIX}{table} does not exist, skipping")
+            continue
+
+        tables.add(table)
+        indexes = get_indexes(database, table)
+        for duplicate, other in find_duplicate_indexes(indexes):
+            print(f"[!] {table}.{duplicate} is redundant with {table}.{other}")
+
+        lookup_columns = tuple(column_name(column) for column in columns)
+        covering = find_covering_index(indexes, lookup_columns, unique)
+        if covering:
+            print(f"[+] {table}({', '.join(lookup_columns)}) covered by {covering}")
+            continue
+
+        print(
+            f"[-] {table}({', '.join(lookup_columns)}) missing"
+            f" {'unique' if unique else 'secondary'} index"
+        )
+        missing.append((table, name, columns, unique))
+
+    if not missing:
+        return
+
+    print("[+] Plans before:")
+    explain_queries(tables)
+
+    if not args.apply:
+        print("[+] Run with --apply to create the missing indexes")
+        return
+
+    for table, name, columns, unique in missing:
+        if unique:
+            duplicate_rows = count_duplicate_rows(
+                table, tuple(column_name(column) for column in columns)
+            )
+            if duplicate_rows:
+                print(
+                    f"[!] {table} has {duplicate_rows} duplicated keys,"
+                    f" merge them before adding {name}"
+                )
+                continue
+
+        print(f"[+] Creating {table}.{name}")
+        database.execute(
+            f"ALTER TABLE {CONFIG.TABLE_PREFIX}{table}"
+            f" ADD {'UNIQUE ' if unique else ''}INDEX {name} ({', '.join(columns)})"
+        )
+
+    print("[+] Plans after:")
+    explain_queries(tables)
+
+
+if __name__ == "__main__":
+    main()
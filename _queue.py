@@ -0,0 +1,137 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from settings import CONFIG
+
+CRAWL_QUEUE_ENABLED = getattr(CONFIG, "CRAWL_QUEUE_ENABLED", True)
+CRAWL_QUEUE_PATH = getattr(CONFIG, "CRAWL_QUEUE_PATH", "state/crawl_queue.sqlite3")
+
+STATE_PENDING = "pending"
+STATE_HYDRATED = "hydrated"
+
+
+class CrawlQueue:
+    # Pages and titles in flight per crawl loop; a title is deleted once committed
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # Durable across process crashes; only an OS crash can lose the last
+            # checkpoints, which are then crawled again
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS cursor (
+                    name TEXT PRIMARY KEY,
+                    page INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS item (
+                    name TEXT NOT NULL,
+                    movie_type TEXT NOT NULL,
+                    tmdb_id INTEGER NOT NULL,
+                    movie_on TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    payload BLOB,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (movie_type, tmdb_id)
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS item_name ON item (name, updated_at)"
+            )
+        return self._conn
+
+    def get_cursor(self, name: str) -> int:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT page FROM cursor WHERE name=?", (name,))
+                .fetchone()
+            )
+        return row[0] if row else 0
+
+    def set_cursor(self, name: str, page: int) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "REPLACE INTO cursor VALUES (?, ?, ?)", (name, page, time.time())
+            )
+            conn.commit()
+
+    def enqueue(self, name: str, movie_type: str, ids: list, movie_on: str) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR IGNORE INTO item VALUES (?, ?, ?, ?, ?, NULL, ?)",
+                [
+                    (name, movie_type, tmdb_id, movie_on, STATE_PENDING, now)
+                    for tmdb_id in ids
+                ],
+            )
+            conn.commit()
+
+    def pending(self, name: str) -> list:
+        with self._lock:
+            return (
+                self._connect()
+                .execute(
+                    "SELECT movie_type, tmdb_id, movie_on FROM item"
+                    " WHERE name=? ORDER BY updated_at",
+                    (name,),
+                )
+                .fetchall()
+            )
+
+    def get_payload(self, name: str, movie_type: str, tmdb_id: int) -> dict:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT payload FROM item"
+                    " WHERE name=? AND movie_type=? AND tmdb_id=? AND state=?",
+                    (name, movie_type, tmdb_id, STATE_HYDRATED),
+                )
+                .fetchone()
+            )
+        if not row:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def set_hydrated(
+        self, name: str, movie_type: str, tmdb_id: int, movie: dict
+    ) -> None:
+        # Only titles enqueued under `name` keep their payload
+        payload = zlib.compress(json.dumps(movie).encode())
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE item SET state=?, payload=?, updated_at=?"
+                " WHERE name=? AND movie_type=? AND tmdb_id=?",
+                (STATE_HYDRATED, payload, time.time(), name, movie_type, tmdb_id),
+            )
+            conn.commit()
+
+    def done(self, name: str, movie_type: str, tmdb_id: int) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "DELETE FROM item WHERE name=? AND movie_type=? AND tmdb_id=?",
+                (name, movie_type, tmdb_id),
+            )
+            conn.commit()
+
+
+crawl_queue = CrawlQueue(path=CRAWL_QUEUE_PATH)
@@ -0,0 +1,98 @@
+import re
+
+from settings import CONFIG
+
+# Bookkeeping tables the crawler owns, created on first use
+CRAWL_TABLES = {
+    "crawl_index": """CREATE TABLE IF NOT EXISTS {prefix}crawl_index (
+        tmdb_id INT UNSIGNED NOT NULL,
+        type VARCHAR(32) NOT NULL,
+        movie_id INT UNSIGNED NOT NULL,
+        fingerprint CHAR(40) NOT NULL DEFAULT '',
+        last_crawled_at DATETIME NULL,
+        next_due_at DATETIME NULL,
+        PRIMARY KEY (tmdb_id, type)
+    )""",
+    "crawl_lease": """CREATE TABLE IF NOT EXISTS {prefix}crawl_lease (
+        lease_key VARCHAR(128) NOT NULL,
+        owner VARCHAR(128) NOT NULL,
+        expires_at DATETIME NOT NULL,
+        PRIMARY KEY (lease_key),
+        KEY expires_at (expires_at)
+    )""",
+}
+
+# Indexes the crawler's lookups rely on: (table, name, columns, unique).
+# The unique keys are what Database.upsert dedupes on.
+LOOKUP_INDEXES = [
+    ("movie", "movie_slug_type", ("slug", "type"), True),
+    ("season", "season_movie_num", ("movieId", "num"), True),
+    ("episode", "episode_movie_season_num", ("movieId", "seasonId", "num"), True),
+    ("genres", "genres_slug", ("slug",), True),
+    ("country", "country_slug", ("slug",), True),
+    ("postmeta", "postmeta_post_meta_key", ("post_id", "meta_key(191)"), False),
+]
+
+# Query shapes the crawler runs, EXPLAINed before and after migrating
+LOOKUP_QUERIES = [
+    (
+        "SELECT id FROM {prefix}movie WHERE slug=%s AND type=%s",
+        ("", CONFIG.TYPE_MOVIE),
+    ),
+    ("SELECT id, num FROM {prefix}season WHERE movieId=%s", (0,)),
+    ("SELECT id FROM {prefix}season WHERE num=%s AND movieId=%s", (1, 0)),
+    ("SELECT num FROM {prefix}episode WHERE movieId=%s AND seasonId=%s", (0, 0)),
+    (
+        "SELECT id FROM {prefix}episode WHERE movieId=%s AND seasonId=%s AND num=%s",
+        (0, 0, 1),
+    ),
+    ("SELECT * FROM {prefix}genres WHERE slug=%s", ("",)),
+    ("SELECT * FROM {prefix}country WHERE slug=%s", ("",)),
+    ("SELECT * FROM {prefix}postmeta WHERE post_id=%s AND meta_key=%s", (0, "")),
+]
+
+
+def ensure_crawl_tables(database) -> None:
+    for ddl in CRAWL_TABLES.values():
+        database.execute(ddl.format(prefix=CONFIG.TABLE_PREFIX))
+
+
+def column_name(column: str) -> str:
+    # "meta_key(191)" -> "meta_key"
+    return re.sub(r"\(\d+\)$", "", column)
+
+
+def get_indexes(database, table: str) -> dict:
+    indexes = {}
+    for name, column, non_unique in database.select_with(
+        "SELECT INDEX_NAME, COLUMN_NAME, NON_UNIQUE FROM information_schema.STATISTICS"
+        " WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s"
+        " ORDER BY INDEX_NAME, SEQ_IN_INDEX",
+        (f"{CONFIG.TABLE_PREFIX}{table}",),
+    ):
+        columns, _ = indexes.get(name, ((), True))
+        indexes[name] = (columns + (column,), not int(non_unique))
+    return indexes
+
+
+def find_covering_index(indexes: dict, columns: tuple, unique: bool) -> str:
+    for name, (index_columns, index_unique) in indexes.items():
+        if unique:
+            # Only a unique key on exactly these columns dedupes an upsert
+            if index_unique and set(index_columns) == set(columns):
+                return name
+        elif index_columns[: len(columns)] == columns:
+            return name
+    return ""
+
+
+def get_upsert_tables(database) -> set:
+    # Tables whose lookup columns carry the unique key Database.upsert needs
+    tables = set()
+    for table, _, columns, unique in LOOKUP_INDEXES:
+        lookup_columns = tuple(column_name(column) for column in columns)
+        if unique and find_covering_index(
+            get_indexes(database, table), lookup_columns, unique
+        ):
+            tables.add(table)
+    return tables
@@ -0,0 +1,46 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+from settings import CONFIG
+
+CRAWL_STATE_PATH = getattr(CONFIG, "CRAWL_STATE_PATH", "state/crawl_state.json")
+
+_lock = threading.Lock()
+
+
+def load_state() -> dict:
+    try:
+        with open(CRAWL_STATE_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(state: dict) -> None:
+    # Write to a temp file and rename so a crash never leaves half a file
+    Path(CRAWL_STATE_PATH).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{CRAWL_STATE_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, CRAWL_STATE_PATH)
+
+
+def get_watermark(media_type: str) -> dict:
+    return load_state().get("watermarks", {}).get(media_type, {})
+
+
+def set_watermark(
+    media_type: str, start_date: str, end_date: str, retry_ids: list = None
+) -> None:
+    with _lock:
+        state = load_state()
+        state.setdefault("watermarks", {})[media_type] = {
+            "start_date": start_date,
+            "end_date": end_date,
+            "retry_ids": sorted(set(retry_ids or [])),
+        }
+        save_state(state)
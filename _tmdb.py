@@ -0,0 +1,311 @@
+import asyncio
+import contextvars
+import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+import aiohttp
+from tmdb import route
+
+from settings import CONFIG
+
+TMDB_REQUESTS_PER_SECOND = getattr(CONFIG, "TMDB_REQUESTS_PER_SECOND", 40)
+TMDB_BURST = getattr(CONFIG, "TMDB_BURST", 20)
+TMDB_MAX_IN_FLIGHT = getattr(CONFIG, "TMDB_MAX_IN_FLIGHT", 20)
+
+TMDB_CACHE_ENABLED = getattr(CONFIG, "TMDB_CACHE_ENABLED", True)
+TMDB_CACHE_PATH = getattr(CONFIG, "TMDB_CACHE_PATH", "cache/tmdb.sqlite3")
+TMDB_CACHE_MAX_BYTES = getattr(CONFIG, "TMDB_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+# Seconds a response is served without asking TMDB; 0 disables caching
+TMDB_CACHE_TTLS = {
+    "changes": 0,
+    "list": 60 * 60,
+    "movie": 24 * 60 * 60,
+    "tv": 6 * 60 * 60,
+    "season": 6 * 60 * 60,
+    "default": 60 * 60,
+    **getattr(CONFIG, "TMDB_CACHE_TTLS", {}),
+}
+
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: int, max_in_flight: int) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_in_flight = max(1, max_in_flight)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._loop = None
+        self._lock = None
+        self._in_flight = None
+
+    def scale(self, fraction: float) -> None:
+        # Give this process its share of the quota when several crawl at once
+        self.rate *= fraction
+        self.burst = max(1, int(self.burst * fraction))
+        self.max_in_flight = max(1, int(self.max_in_flight * fraction))
+        self._tokens = min(self._tokens, float(self.burst))
+        self._loop = None
+
+    def _bind(self) -> None:
+        # asyncio primitives belong to one loop; entry scripts may run several.
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    async def acquire(self) -> None:
+        self._bind()
+        await self._in_flight.acquire()
+        try:
+            async with self._lock:
+                self._refill()
+                while self._tokens < 1:
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+                    self._refill()
+                self._tokens -= 1
+        except BaseException:
+            self._in_flight.release()
+            raise
+
+    def release(self) -> None:
+        self._in_flight.release()
+
+    async def __aenter__(self) -> "RateLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+
+limiter = RateLimiter(
+    rate=TMDB_REQUESTS_PER_SECOND,
+    burst=TMDB_BURST,
+    max_in_flight=TMDB_MAX_IN_FLIGHT,
+)
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # A crash may lose the last commits but never corrupts the cache;
+            # skips the fsync on every commit
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS response (
+                    key TEXT PRIMARY KEY,
+                    etag TEXT,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS response_fetched_at ON response (fetched_at)"
+            )
+            self._size = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM response"
+            ).fetchone()[0]
+        return self._conn
+
+    def get(self, key: str):
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT etag, body, expires_at FROM response WHERE key=?", (key,)
+                )
+                .fetchone()
+            )
+        if not row:
+            return None
+
+        etag, body, expires_at = row
+        return etag, json.loads(zlib.decompress(body)), expires_at
+
+    def put(self, key: str, result: dict, etag: str, ttl: int) -> None:
+        body = zlib.compress(json.dumps(result).encode())
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            old = conn.execute(
+                "SELECT size FROM response WHERE key=?", (key,)
+            ).fetchone()
+            conn.execute(
+                "REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)",
+                (key, etag, body, len(body), now, now + ttl),
+            )
+            self._size += len(body) - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict(conn)
+            conn.commit()
+
+    def touch(self, key: str, ttl: int) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE response SET fetched_at=?, expires_at=? WHERE key=?",
+                (now, now + ttl, key),
+            )
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        # Drop the least recently fetched responses until 90% of the budget is free
+        target = self.max_bytes * 0.9
+        rows = conn.execute("SELECT key, size FROM response ORDER BY fetched_at")
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        conn.executemany("DELETE FROM response WHERE key=?", evicted)
+
+
+response_cache = ResponseCache(path=TMDB_CACHE_PATH, max_bytes=TMDB_CACHE_MAX_BYTES)
+
+
+def get_cache_ttl(path: str) -> int:
+    if path.endswith("changes"):
+        kind = "changes"
+    elif re.fullmatch(r"tv/\d+/season/\d+", path):
+        kind = "season"
+    elif re.fullmatch(r"(movie|tv)/\d+", path):
+        kind = path.split("/")[0]
+    elif re.fullmatch(r"(movie|tv)/[a-z_]+", path):
+        kind = "list"
+    else:
+        kind = "default"
+    return TMDB_CACHE_TTLS.get(kind, TMDB_CACHE_TTLS["default"])
+
+
+_session = None
+_session_loop = None
+
+# Set by force_revalidation(); fresh cache entries are still checked with TMDB
+_revalidate = contextvars.ContextVar("tmdb_revalidate", default=False)
+
+
+@contextmanager
+def force_revalidation():
+    # For feeds that report a title as changed: a cached copy may predate it.
+    # Tasks started inside the block inherit the flag.
+    token = _revalidate.set(True)
+    try:
+        yield
+    finally:
+        _revalidate.reset(token)
+
+
+def get_session() -> aiohttp.ClientSession:
+    # One keep-alive session per event loop, shared by every route object
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=TMDB_MAX_IN_FLIGHT)
+        )
+        _session_loop = loop
+    return _session
+
+
+async def close_session() -> None:
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _session_loop = None
+
+
+class TmdbRequest:
+    def __init__(self, **kwargs) -> None:
+        kwargs.setdefault("session", get_session())
+        super().__init__(**kwargs)
+
+    async def request(self, path: str, method: str = "GET", **kwargs):
+        url = f"{self.host}/{self.version}/{path}"
+        params = {
+            k.replace("__", "."): "true" if v is True else "false" if v is False else v
+            for k, v in kwargs.items()
+            if v is not None
+        }
+        params = {**self.default_params, **params}
+
+        ttl = get_cache_ttl(path) if TMDB_CACHE_ENABLED and method == "GET" else 0
+        key = f"{path}?" + "&".join(
+            f"{k}={v}" for k, v in sorted(params.items()) if k != "api_key"
+        )
+        # sqlite, zlib and the commit stay off the event loop
+        cached = await asyncio.to_thread(response_cache.get, key) if ttl else None
+        if cached and cached[2] > time.time() and not _revalidate.get():
+            return route.Response(cached[1])
+
+        headers = {}
+        if cached and cached[0]:
+            headers["If-None-Match"] = cached[0]
+
+        async with limiter:
+            async with self.session.request(
+                method, url=url, params=params, headers=headers
+            ) as response:
+                if response.status == 304 and cached:
+                    await asyncio.to_thread(response_cache.touch, key, ttl)
+                    return route.Response(cached[1])
+                if not response.ok:
+                    response.raise_for_status()
+                result = await response.json()
+                etag = response.headers.get("ETag")
+
+        if "watch/providers" in result:
+            result["watch_providers"] = result.pop("watch/providers")
+        if ttl:
+            await asyncio.to_thread(response_cache.put, key, result, etag, ttl)
+        return route.Response(result)
+
+
+class Movie(TmdbRequest, route.Movie):
+    async def changes_list(
+        self, *, start_date: str = None, end_date: str = None, page: int = 1
+    ) -> route.Response:
+        return await self.request(
+            "movie/changes", start_date=start_date, end_date=end_date, page=page
+        )
+
+
+class Show(TmdbRequest, route.Show):
+    async def changes_list(
+        self, *, start_date: str = None, end_date: str = None, page: int = 1
+    ) -> route.Response:
+        return await self.request(
+            "tv/changes", start_date=start_date, end_date=end_date, page=page
+        )
+
+
+class Season(TmdbRequest, route.Season):
+    pass
@@ -0,0 +1,103 @@
+import asyncio
+import multiprocessing
+import queue
+import time
+
+from _db import Database
+from _tmdb import limiter
+from base import Crawler
+from settings import CONFIG
+
+CRAWL_WORKERS = getattr(CONFIG, "CRAWL_WORKERS", 1)
+# "page": worker i crawls pages first_page + i, + 2i, ...
+# "tmdb_id": every worker walks all pages and keeps ids where id % workers == i
+CRAWL_SHARD_BY = getattr(CONFIG, "CRAWL_SHARD_BY", "page")
+
+
+def run_worker(
+    movie_type: str,
+    first_page: int,
+    worker_index: int,
+    workers: int,
+    stats_queue: multiprocessing.Queue,
+) -> None:
+    limiter.scale(1 / workers)
+
+    def on_page(page: int, total_pages: int, crawl_session) -> None:
+        stats_queue.put(
+            {
+                "worker": worker_index,
+                "page": page,
+                "total_pages": total_pages,
+                "titles": len(crawl_session.seen),
+                "duplicates": crawl_session.duplicates,
+            }
+        )
+
+    if CRAWL_SHARD_BY == "tmdb_id":
+        crawler = Crawler(database=Database(), shard=(worker_index, workers))
+        page_step = 1
+    else:
+        crawler = Crawler(database=Database())
+        first_page += worker_index
+        page_step = workers
+
+    asyncio.run(
+        crawler.crawl_pages_forever(
+            movie_type=movie_type,
+            first_page=first_page,
+            page_step=page_step,
+            on_page=on_page,
+        )
+    )
+
+
+def start_worker(
+    movie_type: str,
+    first_page: int,
+    worker_index: int,
+    workers: int,
+    stats_queue: multiprocessing.Queue,
+) -> multiprocessing.Process:
+    process = multiprocessing.Process(
+        target=run_worker,
+        args=(movie_type, first_page, worker_index, workers, stats_queue),
+        name=f"crawl-{movie_type}-{worker_index}",
+        daemon=True,
+    )
+    process.start()
+    return process
+
+
+def run_sharded(movie_type: str, first_page: int, workers: int = CRAWL_WORKERS):
+    stats_queue = multiprocessing.Queue()
+    processes = [
+        start_worker(movie_type, first_page, i, workers, stats_queue)
+        for i in range(workers)
+    ]
+    stats = {}
+    pages_done = 0
+
+    while True:
+        try:
+            worker_stats = stats_queue.get(timeout=60)
+            pages_done += 1
+            # Per-worker counters reset each pass, so keep the latest of each
+            stats[worker_stats["worker"]] = worker_stats
+            print(
+                f"[+] Worker {worker_stats['worker']} finished page "
+                f"{worker_stats['page']}/{worker_stats['total_pages']} | "
+                f"pages: {pages_done}, "
+                f"titles: {sum(s['titles'] for s in stats.values())}, "
+                f"duplicates: {sum(s['duplicates'] for s in stats.values())}"
+            )
+        except queue.Empty:
+            pass
+
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                print(f"[!] Worker {i} exited with {process.exitcode}, restarting")
+                time.sleep(CONFIG.WAIT_BETWEEN_CRAWL_ALL)
+                processes[i] = start_worker(
+                    movie_type, first_page, i, workers, stats_queue
+                )
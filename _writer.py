@@ -0,0 +1,93 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from _db import Database
+from settings import CONFIG
+
+CRAWL_WRITE_BEHIND = getattr(CONFIG, "CRAWL_WRITE_BEHIND", True)
+# Hydrated titles waiting for the writer; fetchers block when it is full
+CRAWL_WRITE_QUEUE_SIZE = getattr(CONFIG, "CRAWL_WRITE_QUEUE_SIZE", 20)
+# Titles the writer groups into one commit; 1 commits every title on its own
+CRAWL_WRITE_BATCH = getattr(CONFIG, "CRAWL_WRITE_BATCH", 10)
+
+
+class WriteBehind:
+    # Runs `write(*args)` on a dedicated thread, a batch per transaction
+    def __init__(
+        self,
+        database: Database,
+        write,
+        maxsize: int = CRAWL_WRITE_QUEUE_SIZE,
+        batch_size: int = CRAWL_WRITE_BATCH,
+    ) -> None:
+        self._database = database
+        self._write = write
+        self.maxsize = max(1, maxsize)
+        self.batch_size = max(1, batch_size)
+        self._queue = None
+        self._task = None
+        self._executor = None
+
+    def _start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="db-writer"
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def write(self, *args) -> None:
+        # Resolves once the batch holding this write has been committed
+        if self._task is None:
+            self._start()
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((args, future))
+        await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            try:
+                errors = await loop.run_in_executor(
+                    self._executor, self._write_batch, [args for args, _ in batch]
+                )
+            except Exception as e:
+                errors = [e] * len(batch)
+
+            for (_, future), error in zip(batch, errors):
+                if future.done():
+                    pass
+                elif error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+                self._queue.task_done()
+
+    def _write_batch(self, batch: list) -> list:
+        errors = []
+        with self._database.group_commit(len(batch)):
+            for args in batch:
+                try:
+                    self._write(*args)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(e)
+        return errors
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+
+        await self._queue.join()
+        self._task.cancel()
+        self._executor.shutdown(wait=True)
+        self._queue = None
+        self._task = None
+        self._executor = None
@@ -1,33 +1,110 @@
 import asyncio
 import json
 import sys
-from time import sleep
+from contextlib import nullcontext
+from datetime import datetime, timedelta
 
 from icecream import ic
 from tmdb import route
 
+from _aiodb import AsyncDatabase
 from _db import Database
+from _lease import CRAWL_LEASES, LeaseManager
+from _queue import CRAWL_QUEUE_ENABLED, crawl_queue
+from _state import get_watermark, set_watermark
+from _tmdb import Movie, Season, Show, close_session, force_revalidation
+from _writer import CRAWL_WRITE_BEHIND, WriteBehind
 from settings import CONFIG
-from soap2day import Soap2day
+from soap2day import ENDED_STATUSES, Soap2day, slug_cache
 
 base = route.Base()
 base.key = CONFIG.TMDB_API_KEY
 
+CRAWL_CONCURRENCY = getattr(CONFIG, "CRAWL_CONCURRENCY", 5)
+TMDB_APPEND_TO_RESPONSE = getattr(CONFIG, "TMDB_APPEND_TO_RESPONSE", True)
+# TMDB accepts at most 20 append_to_response entries per request.
+TMDB_MAX_APPEND = 20
+# The changes endpoints only accept a window of up to 14 days
+TMDB_MAX_CHANGES_DAYS = 14
+# Only crawl changed titles we already host
+CHANGES_KNOWN_ONLY = getattr(CONFIG, "CHANGES_KNOWN_ONLY", True)
+# Skip popular-page titles crawled less than their TTL ago
+CRAWL_SKIP_FRESH = getattr(CONFIG, "CRAWL_SKIP_FRESH", True)
+# TMDB refuses list pages past this, whatever total_pages says
+TMDB_MAX_PAGES = 500
+# Only fetch seasons that are new, missing episodes or still airing
+CRAWL_SKIP_COMPLETE_SEASONS = getattr(CONFIG, "CRAWL_SKIP_COMPLETE_SEASONS", True)
+
+
+class CrawlSession:
+    # Shared by every feed in one cycle so a title is hydrated at most once
+    def __init__(self) -> None:
+        self.seen = set()
+        self.duplicates = 0
+
+    def claim(self, movie_type: str, movie_id: int) -> bool:
+        key = (movie_type, movie_id)
+        if key in self.seen:
+            self.duplicates += 1
+            return False
+
+        self.seen.add(key)
+        return True
+
+    def report(self) -> str:
+        return (
+            f"{len(self.seen)} titles crawled, {self.duplicates} duplicates suppressed"
+        )
+
 
 class Crawler:
-    def __init__(self, database: Database) -> None:
+    def __init__(
+        self,
+        database: Database,
+        concurrency: int = CRAWL_CONCURRENCY,
+        crawl_session: CrawlSession = None,
+        shard: tuple = (0, 1),
+        leases: LeaseManager = None,
+    ) -> None:
+        self._database = database
+        # Blocking DB calls made from coroutines go through this thread pool
+        self.db = AsyncDatabase(database)
         self._soap2day = Soap2day(database=database)
+        self._concurrency = max(1, concurrency)
+        self.crawl_session = crawl_session or CrawlSession()
+        # (index, count): only crawl TMDB ids where id % count == index
+        self.shard = shard
+        # Page leases shared with other nodes crawling the same database
+        if leases is None and CRAWL_LEASES:
+            leases = LeaseManager(database)
+        self.leases = leases
+        # Durable queue of titles in flight, scoped to one crawl_pages_forever
+        # loop; unused while queue_name is empty
+        self.queue = crawl_queue if CRAWL_QUEUE_ENABLED else None
+        self.queue_name = ""
+        # Title writes run on a writer thread while fetching carries on
+        self.writer = (
+            WriteBehind(database, write=self.write_movie)
+            if CRAWL_WRITE_BEHIND
+            else None
+        )
 
-    async def get_trailer_from_movie_or_show(self, movie: dict, movie_type: str) -> str:
+    def get_append_to_response(self, movie_type: str) -> str:
         if movie_type == CONFIG.TYPE_MOVIE:
-            videos = await route.Movie().videos(movie.get("id"))
+            return "credits,keywords,videos"
+
+        return "aggregate_credits,keywords,videos"
+
+    async def get_trailer_from_movie_or_show(self, movie: dict, movie_type: str) -> str:
+        if isinstance(movie.get("videos"), dict):
+            videos = movie["videos"]
+        elif movie_type == CONFIG.TYPE_MOVIE:
+            videos = await Movie().videos(movie.get("id"))
         else:
-            videos = await route.Show().videos(movie.get("id"))
+            videos = await Show().videos(movie.get("id"))
         if not isinstance(videos, dict):
             return ""
 
-        sleep(CONFIG.WAIT_BETWEEN_TMDB_REQUEST)
-
         videos = videos.get("results", [])
         for video in videos:
             if video.get("type", "").lower() == "trailer":
@@ -39,14 +116,16 @@ class Crawler:
         self, movie: dict, movie_type: str
     ):
         if movie_type == CONFIG.TYPE_MOVIE:
-            credits = await route.Movie().credits(movie.get("id"))
+            credits = movie.get("credits")
+            if not isinstance(credits, dict):
+                credits = await Movie().credits(movie.get("id"))
         else:
-            credits = await route.Show().aggregate_credits(movie.get("id"))
+            credits = movie.get("aggregate_credits")
+            if not isinstance(credits, dict):
+                credits = await Show().aggregate_credits(movie.get("id"))
         if not isinstance(credits, dict):
             return "", ""
 
-        sleep(CONFIG.WAIT_BETWEEN_TMDB_REQUEST)
-
         casts = credits.get("cast", [])
         casts_name = [
             cast.get("name", cast.get("original_name", ""))
@@ -65,189 +144,551 @@ class Crawler:
         return casts_name, productions_name
 
     async def get_movie_or_show_keywords(self, movie: dict, movie_type: str) -> list:
-        if movie_type == CONFIG.TYPE_MOVIE:
-            credits = await route.Movie().keywords(movie.get("id"))
+        if isinstance(movie.get("keywords"), dict):
+            credits = movie["keywords"]
+        elif movie_type == CONFIG.TYPE_MOVIE:
+            credits = await Movie().keywords(movie.get("id"))
         else:
-            credits = await route.Show().keywords(movie.get("id"))
+            credits = await Show().keywords(movie.get("id"))
         if not isinstance(credits, dict):
             return "", ""
 
-        sleep(CONFIG.WAIT_BETWEEN_TMDB_REQUEST)
-
-        results = credits.get("results", [])
+        # Movies list their keywords under "keywords", shows under "results"
+        results = credits.get("results", credits.get("keywords", []))
         results_name = [
             result.get("name", "") for result in results if isinstance(result, dict)
         ]
 
         return results_name
 
-    async def crawl_show_season(
+    async def get_show_seasons(self, show_id: int, season_numbers: list) -> dict:
+        if not TMDB_APPEND_TO_RESPONSE:
+            return {}
+
+        season_numbers = [number for number in season_numbers if number]
+        batches = [
+            season_numbers[i : i + TMDB_MAX_APPEND]
+            for i in range(0, len(season_numbers), TMDB_MAX_APPEND)
+        ]
+        responses = await asyncio.gather(
+            *[
+                Show().details(
+                    show_id,
+                    append=",".join(f"season/{number}" for number in batch),
+                )
+                for batch in batches
+            ],
+            return_exceptions=True,
+        )
+
+        seasons = {}
+        for batch, response in zip(batches, responses):
+            if not isinstance(response, dict):
+                continue
+
+            for number in batch:
+                season = response.get(f"season/{number}")
+                if isinstance(season, dict):
+                    seasons[number] = season
+
+        return seasons
+
+    def insert_season_episodes(
         self,
         inserted_movie_id: int,
+        inserted_season_id: int,
         show_id: int,
         season_number: int,
+        episodes: list,
         movie_cover_url: str,
     ) -> None:
-        if not season_number:
-            return
+        self._soap2day.get_or_insert_episodes(
+            movie_id=inserted_movie_id,
+            season_id=inserted_season_id,
+            thumb_url=movie_cover_url,
+            episodes=[
+                (
+                    episode,
+                    [
+                        {
+                            "server_name": "VidSrc",
+                            "server_link": f"https://vidsrc.to/embed/tv/{show_id}/{season_number}/{episode.get('episode_number', 0)}",
+                            "server_type": "embed",
+                        }
+                    ],
+                )
+                for episode in episodes
+                if isinstance(episode, dict)
+            ],
+        )
+
+    def insert_show_seasons(
+        self,
+        inserted_movie_id: int,
+        show_id: int,
+        season_details: dict,
+        movie_cover_url: str,
+    ) -> None:
+        season_ids = self._soap2day.get_or_insert_seasons(
+            movie_id=inserted_movie_id,
+            seasons=[
+                (season_number, season.get("name", ""))
+                for season_number, season in season_details.items()
+            ],
+        )
 
-        season = await route.Season().details(
-            tv_id=show_id, season_number=season_number
+        for season_number, season in season_details.items():
+            inserted_season_id = season_ids.get(season_number)
+            if not inserted_season_id:
+                continue
+
+            self.insert_season_episodes(
+                inserted_movie_id=inserted_movie_id,
+                inserted_season_id=inserted_season_id,
+                show_id=show_id,
+                season_number=season_number,
+                episodes=season.get("episodes", []),
+                movie_cover_url=movie_cover_url,
+            )
+
+    async def get_outdated_season_numbers(
+        self, show: dict, movie_type: str, is_unchanged: bool = False
+    ) -> list:
+        seasons = [
+            season for season in show.get("seasons", []) if season.get("season_number")
+        ]
+        if not CRAWL_SKIP_COMPLETE_SEASONS:
+            if is_unchanged:
+                return []
+            return [season.get("season_number") for season in seasons]
+
+        episode_counts = await self.db.run(
+            self._soap2day.get_episode_counts, show.get("id", 0), movie_type
         )
 
-        if not isinstance(season, dict):
+        # Airing seasons only matter when the show itself changed; seasons
+        # missing episodes are repaired either way
+        airing_numbers = set()
+        if not is_unchanged:
+            airing_keys = ["next_episode_to_air"]
+            if show.get("status", "") not in ENDED_STATUSES:
+                airing_keys.append("last_episode_to_air")
+            airing_numbers = {
+                (show.get(key) or {}).get("season_number", 0) for key in airing_keys
+            }
+
+        season_numbers = []
+        for season in seasons:
+            season_number = season.get("season_number", 0)
+            if (
+                season_number in airing_numbers
+                or season_number not in episode_counts
+                or episode_counts[season_number] < season.get("episode_count", 0)
+            ):
+                season_numbers.append(season_number)
+
+        skipped = len(seasons) - len(season_numbers)
+        if episode_counts and skipped:
+            print(f"[+] Skipping {skipped} complete seasons of TV ID: {show.get('id')}")
+        return season_numbers
+
+    async def hydrate_movie(
+        self, movie_id: int, movie_type: str, movie_on: str = "Other"
+    ) -> dict:
+        append = self.get_append_to_response(movie_type)
+        if not TMDB_APPEND_TO_RESPONSE:
+            append = None
+
+        if movie_type == CONFIG.TYPE_MOVIE:
+            movie = await Movie().details(movie_id, append=append)
+        else:
+            movie = await Show().details(movie_id, append=append)
+
+        if not isinstance(movie, dict):
             # TODO: Noti
-            return
+            return None
 
-        sleep(CONFIG.WAIT_BETWEEN_TMDB_REQUEST)
+        print(
+            f'[+] Crawling {movie_type} name: {movie.get("original_name", movie.get("original_title", ""))}'
+        )
 
-        inserted_season_id = self._soap2day.get_or_insert_season(
-            movie_id=inserted_movie_id,
-            season_number=season_number,
-            season_name=season.get("name", ""),
+        (casts, directors), keywords, trailer_id = await asyncio.gather(
+            self.get_cast_and_production_from_movie_or_show(
+                movie=movie, movie_type=movie_type
+            ),
+            self.get_movie_or_show_keywords(movie=movie, movie_type=movie_type),
+            self.get_trailer_from_movie_or_show(movie=movie, movie_type=movie_type),
+        )
+        movie["casts"] = casts
+        movie["directors"] = directors
+        movie["keywords"] = keywords
+        movie["movie_on"] = movie_on
+        movie["trailer_id"] = trailer_id
+        for key in ("credits", "aggregate_credits", "videos"):
+            movie.pop(key, None)
+
+        return movie
+
+    async def get_season_details(self, show_id: int, season_numbers: list) -> dict:
+        season_details = await self.get_show_seasons(
+            show_id=show_id, season_numbers=season_numbers
         )
 
-        if not inserted_season_id:
-            return
+        missing_numbers = [
+            season_number
+            for season_number in season_numbers
+            if season_number not in season_details
+        ]
+        missing_seasons = await self.gather_bounded(
+            [
+                Season().details(tv_id=show_id, season_number=season_number)
+                for season_number in missing_numbers
+            ]
+        )
+        for season_number, season in zip(missing_numbers, missing_seasons):
+            if isinstance(season, dict):
+                season_details[season_number] = season
 
-        episodes = season.get("episodes", [])
-        for episode in episodes:
-            self._soap2day.get_or_insert_episode(
-                movie_id=inserted_movie_id,
-                season_id=inserted_season_id,
-                episode=episode,
-                thumb_url=movie_cover_url,
-                episode_data=[
-                    {
-                        "server_name": "VidSrc",
-                        "server_link": f"https://vidsrc.to/embed/tv/{show_id}/{season_number}/{episode.get('episode_number', 0)}",
-                        "server_type": "embed",
-                    }
-                ],
-            )
+        return season_details
 
     async def crawl_movie_by_id(
         self, movie_id: int, movie_type: str, movie_on: str = "Other"
-    ) -> None:
+    ) -> bool:
         try:
-            if movie_type == CONFIG.TYPE_MOVIE:
-                movie = await route.Movie().details(movie_id)
+            movie = await asyncio.to_thread(self.get_queued_movie, movie_id, movie_type)
+            if movie:
+                print(f"[+] Resuming hydrated {movie_type} ID: {movie_id}")
             else:
-                movie = await route.Show().details(movie_id)
+                movie = await self.hydrate_movie(
+                    movie_id, movie_type=movie_type, movie_on=movie_on
+                )
+                if not movie:
+                    return True
 
-            if not isinstance(movie, dict):
-                # TODO: Noti
-                return
+            # with open("test/movie.json", "w") as f:
+            #     f.write(json.dumps(movie, indent=4))
+            # sys.exit(0)
 
-            print(
-                f'[+] Crawling {movie_type} name: {movie.get("original_name", movie.get("original_title", ""))}'
+            unchanged_movie_id = await self.db.run(
+                self._soap2day.get_unchanged_movie_id, movie, movie_type
             )
+            if movie_type == CONFIG.TYPE_TV_SHOWS and "season_details" not in movie:
+                # Seasons are fetched after the unchanged check so an unchanged
+                # show only pays for seasons that still need repairing
+                season_numbers = await self.get_outdated_season_numbers(
+                    show=movie,
+                    movie_type=movie_type,
+                    is_unchanged=bool(unchanged_movie_id),
+                )
+                movie["season_details"] = await self.get_season_details(
+                    show_id=movie_id, season_numbers=season_numbers
+                )
+                if season_numbers:
+                    unchanged_movie_id = 0
+            if self.queue and self.queue_name and not unchanged_movie_id:
+                await asyncio.to_thread(
+                    self.queue.set_hydrated,
+                    self.queue_name,
+                    movie_type,
+                    movie_id,
+                    movie,
+                )
 
-            sleep(CONFIG.WAIT_BETWEEN_TMDB_REQUEST)
+            if unchanged_movie_id:
+                print(f"[+] Unchanged {movie_type} ID: {movie_id}, skipping")
+                await self.db.run(
+                    self._soap2day.mark_movie_crawled,
+                    movie_data=movie,
+                    movie_type=movie_type,
+                    movie_id=unchanged_movie_id,
+                )
+                return True
 
-            casts, directors = await self.get_cast_and_production_from_movie_or_show(
-                movie=movie, movie_type=movie_type
-            )
-            keywords = await self.get_movie_or_show_keywords(
-                movie=movie, movie_type=movie_type
-            )
-            movie["casts"] = casts
-            movie["directors"] = directors
-            movie["keywords"] = keywords
-            movie["movie_on"] = movie_on
-            movie["trailer_id"] = await self.get_trailer_from_movie_or_show(
-                movie=movie, movie_type=movie_type
-            )
-            # with open("test/movie.json", "w") as f:
-            #     f.write(json.dumps(movie, indent=4))
-            # sys.exit(0)
+            if self.writer:
+                await self.writer.write(movie_id, movie, movie_type)
+            else:
+                await self.db.run(
+                    self.write_movie, movie_id, movie=movie, movie_type=movie_type
+                )
 
-            movie_cover_url = f"{CONFIG.TMDB_IMAGE_PREFIX}{movie.get('backdrop_path', movie.get('poster_path', ''))}"
+            return True
+        except Exception as e:
+            print(e)
+            return False
 
-            inserted_movie_id = self._soap2day.insert_movie(
-                movie_data=movie, movie_type=movie_type
-            )
-            if inserted_movie_id:
-                if movie_type == CONFIG.TYPE_TV_SHOWS:
-                    seasons = movie.get("seasons", [])
-                    for season in seasons:
-                        season_number = season.get("season_number", 0)
-                        await self.crawl_show_season(
+    def write_movie(self, movie_id: int, movie: dict, movie_type: str) -> None:
+        movie_cover_url = f"{CONFIG.TMDB_IMAGE_PREFIX}{movie.get('backdrop_path', movie.get('poster_path', ''))}"
+
+        try:
+            with self._database.transaction():
+                inserted_movie_id = self._soap2day.insert_movie(
+                    movie_data=movie, movie_type=movie_type
+                )
+                if inserted_movie_id:
+                    if movie_type == CONFIG.TYPE_TV_SHOWS:
+                        self.insert_show_seasons(
                             inserted_movie_id=inserted_movie_id,
                             show_id=movie_id,
-                            season_number=season_number,
+                            season_details=movie.get("season_details", {}),
                             movie_cover_url=movie_cover_url,
                         )
-                else:
-                    self._soap2day.get_or_insert_episode(
+                    else:
+                        self._soap2day.get_or_insert_episode(
+                            movie_id=inserted_movie_id,
+                            season_id=0,
+                            episode={"episode_number": 1},
+                            thumb_url=movie_cover_url,
+                            episode_data=[
+                                {
+                                    "server_name": "VidSrc",
+                                    "server_link": f"https://vidsrc.to/embed/movie/{movie_id}",
+                                    "server_type": "embed",
+                                }
+                            ],
+                        )
+                        pass
+
+                    self._soap2day.mark_movie_crawled(
+                        movie_data=movie,
+                        movie_type=movie_type,
                         movie_id=inserted_movie_id,
-                        season_id=0,
-                        episode={"episode_number": 1},
-                        thumb_url=movie_cover_url,
-                        episode_data=[
-                            {
-                                "server_name": "VidSrc",
-                                "server_link": f"https://vidsrc.to/embed/movie/{movie_id}",
-                                "server_type": "embed",
-                            }
-                        ],
                     )
-                    pass
+        except Exception:
+            # Rows upserted by the rolled back transaction may still be cached
+            slug_cache.clear()
+            raise
+
+    def get_queued_movie(self, movie_id: int, movie_type: str) -> dict:
+        if not (self.queue and self.queue_name):
+            return None
+
+        movie = self.queue.get_payload(self.queue_name, movie_type, movie_id)
+        if movie and "season_details" in movie:
+            # JSON turned the season numbers into strings
+            movie["season_details"] = {
+                int(season_number): season
+                for season_number, season in movie["season_details"].items()
+            }
+        return movie
+
+    async def crawl_and_checkpoint(
+        self, movie_id: int, movie_type: str, movie_on: str = "Other"
+    ) -> bool:
+        is_crawled = await self.crawl_movie_by_id(
+            movie_id, movie_type=movie_type, movie_on=movie_on
+        )
+        if is_crawled and self.queue and self.queue_name:
+            await asyncio.to_thread(
+                self.queue.done, self.queue_name, movie_type, movie_id
+            )
+        return is_crawled
 
-        except Exception as e:
-            print(e)
+    async def crawl_queued_titles(self) -> None:
+        items = [
+            (movie_type, movie_id, movie_on)
+            for movie_type, movie_id, movie_on in self.queue.pending(self.queue_name)
+            if self.crawl_session.claim(movie_type, movie_id)
+        ]
+        if not items:
+            return
+
+        print(f"[+] Resuming {len(items)} queued titles")
+        await self.gather_bounded(
+            [
+                self.crawl_and_checkpoint(
+                    movie_id, movie_type=movie_type, movie_on=movie_on
+                )
+                for movie_type, movie_id, movie_on in items
+            ]
+        )
+
+    async def gather_bounded(self, coros: list) -> list:
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def run(coro):
+            async with semaphore:
+                return await coro
+
+        return await asyncio.gather(
+            *[run(coro) for coro in coros], return_exceptions=True
+        )
+
+    async def crawl_results(
+        self, results: list, movie_type: str, movie_on: str = "Other"
+    ) -> list:
+        movie_ids = []
+        for result in results:
+            movie_id = result.get("id", 0)
+            if not movie_id or movie_id % self.shard[1] != self.shard[0]:
+                continue
+            if self.crawl_session.claim(movie_type, movie_id):
+                movie_ids.append(movie_id)
+
+        if self.queue and self.queue_name:
+            self.queue.enqueue(self.queue_name, movie_type, movie_ids, movie_on)
+
+        crawled = await self.gather_bounded(
+            [
+                self.crawl_and_checkpoint(
+                    movie_id, movie_type=movie_type, movie_on=movie_on
+                )
+                for movie_id in movie_ids
+            ]
+        )
+
+        return [
+            movie_id
+            for movie_id, is_crawled in zip(movie_ids, crawled)
+            if is_crawled is not True
+        ]
 
     async def crawl_movies_or_shows_by_page(
         self, movie_type: str, page: int = 1, movie_on: str = "Other"
     ) -> int:
         if movie_type == CONFIG.TYPE_MOVIE:
-            movies = await route.Movie().popular(page=page)
+            movies = await Movie().popular(page=page)
         else:
-            movies = await route.Show().popular(page=page)
+            movies = await Show().popular(page=page)
 
         if not isinstance(movies, dict):
             # TODO: Noti
             return 0
 
-        sleep(CONFIG.WAIT_BETWEEN_TMDB_REQUEST)
-
         total_pages = movies.get("total_pages", 0)
         results = movies.get("results", [])
+        if CRAWL_SKIP_FRESH:
+            fresh_ids = await self.db.run(
+                self._soap2day.get_fresh_tmdb_ids,
+                [result.get("id", 0) for result in results if result.get("id", 0)],
+                movie_type,
+            )
+            if fresh_ids:
+                print(f"[+] Skipping {len(fresh_ids)} fresh titles on page {page}")
+            results = [
+                result for result in results if result.get("id", 0) not in fresh_ids
+            ]
 
-        for result in results:
-            movie_id = result.get("id", 0)
-            if not movie_id:
-                continue
+        await self.crawl_results(results, movie_type=movie_type, movie_on=movie_on)
+
+        return total_pages
 
-            await self.crawl_movie_by_id(
-                movie_id, movie_type=movie_type, movie_on=movie_on
+    async def crawl_pages_forever(
+        self,
+        movie_type: str,
+        first_page: int = 1,
+        page_step: int = 1,
+        on_page=None,
+    ) -> None:
+        page = first_page
+        total_pages = TMDB_MAX_PAGES
+        crawled_in_lap = False
+        if self.queue:
+            self.queue_name = (
+                f"{movie_type}:{first_page}+{page_step}:{self.shard[0]}/{self.shard[1]}"
             )
+            page = self.queue.get_cursor(self.queue_name) or first_page
+            if page != first_page:
+                print(f"[+] Resuming from page: {page}")
 
-        return total_pages
+        try:
+            while True:
+                try:
+                    if self.queue:
+                        await self.crawl_queued_titles()
+                    lease_key = f"{movie_type}:page:{page}"
+                    if self.shard[1] > 1:
+                        # tmdb_id shards walk the same pages, each for its own ids
+                        lease_key += f":shard:{self.shard[0]}/{self.shard[1]}"
+                    leased = self.leases and not await self.db.run(
+                        self.leases.claim, lease_key
+                    )
+                    if leased:
+                        owner = await self.db.run(self.leases.get_owner, lease_key)
+                        if owner == self.leases.owner:
+                            print(f"[+] Page {page} was crawled recently, skipping")
+                        else:
+                            print(f"[+] Page {page} is leased by {owner}")
+                    else:
+                        crawled_in_lap = True
+                        print(f"[+] Crawling page: {page}")
+                        async with (
+                            self.leases.hold(lease_key, run=self.db.run)
+                            if self.leases
+                            else nullcontext()
+                        ):
+                            total_pages = await self.crawl_movies_or_shows_by_page(
+                                page=page, movie_type=movie_type
+                            )
+                        if on_page:
+                            on_page(page, total_pages, self.crawl_session)
+
+                    page += page_step
+                    idle_lap = False
+                    if page > min(total_pages, TMDB_MAX_PAGES):
+                        page = first_page
+                        print(f"[+] Finished all pages: {self.crawl_session.report()}")
+                        self.crawl_session = CrawlSession()
+                        if self.leases:
+                            await self.db.run(self.leases.purge_expired)
+                        idle_lap = not crawled_in_lap
+                        crawled_in_lap = False
+                    if self.queue and (not leased or page == first_page):
+                        self.queue.set_cursor(self.queue_name, page)
+                    # Leased pages are skipped without waiting, but a lap where
+                    # every page was leased backs off before starting over
+                    if leased and not idle_lap:
+                        continue
+
+                except Exception as e:
+                    print(e)
+                await asyncio.sleep(CONFIG.WAIT_BETWEEN_CRAWL_ALL)
+        finally:
+            if self.writer:
+                await self.writer.close()
+            self.db.close()
+            await close_session()
+
+    async def update_forever(self) -> None:
+        try:
+            while True:
+                self.crawl_session = CrawlSession()
+                try:
+                    await self.crawl_airing_today_shows()
+                except Exception as e:
+                    print(e)
+                await asyncio.sleep(CONFIG.WAIT_BETWEEN_UPDATE)
+
+                for movie_type in (CONFIG.TYPE_TV_SHOWS, CONFIG.TYPE_MOVIE):
+                    try:
+                        await self.crawl_changes_shows(movie_type=movie_type)
+                    except Exception as e:
+                        print(e)
+
+                print(f"[+] Update cycle done: {self.crawl_session.report()}")
+                await asyncio.sleep(CONFIG.WAIT_BETWEEN_UPDATE)
+        finally:
+            if self.writer:
+                await self.writer.close()
+            self.db.close()
+            await close_session()
 
     async def crawl_airing_today_shows(self) -> None:
         page = 1
 
         while True:
             print(f"[+] Crawling airing today page: {page}")
-            movies = await route.Show().airing_today(page=page)
+            movies = await Show().airing_today(page=page)
 
             if not isinstance(movies, dict):
                 # TODO: Noti
                 return 0
 
-            sleep(CONFIG.WAIT_BETWEEN_TMDB_REQUEST)
-
             total_pages = movies.get("total_pages", 0)
             results = movies.get("results", [])
 
-            for result in results:
-                movie_id = result.get("id", 0)
-                if not movie_id:
-                    continue
-
-                await self.crawl_movie_by_id(
-                    movie_id, movie_type=CONFIG.TYPE_TV_SHOWS, movie_on="Airing"
+            with force_revalidation():
+                await self.crawl_results(
+                    results, movie_type=CONFIG.TYPE_TV_SHOWS, movie_on="Airing"
                 )
 
             page += 1
@@ -255,32 +696,65 @@ class Crawler:
                 break
 
     async def crawl_changes_shows(self, movie_type: str) -> None:
-        page = 1
+        watermark = get_watermark(movie_type)
+        end_date = datetime.utcnow().date()
+        start_date = end_date - timedelta(days=TMDB_MAX_CHANGES_DAYS)
+        if watermark.get("end_date"):
+            start_date = max(
+                start_date,
+                datetime.strptime(watermark["end_date"], "%Y-%m-%d").date(),
+            )
+
+        print(f"[+] Crawling {movie_type} changes from {start_date} to {end_date}")
+        if CHANGES_KNOWN_ONLY:
+            # Pick up titles the page crawlers added since the last cycle
+            await self.db.run(self._soap2day.load_known_ids)
+        with force_revalidation():
+            failed_ids = await self.crawl_results(
+                [{"id": movie_id} for movie_id in watermark.get("retry_ids", [])],
+                movie_type=movie_type,
+            )
 
+        page = 1
         while True:
             if movie_type == CONFIG.TYPE_MOVIE:
-                movies = await route.Movie().changes(page=page)
+                movies = await Movie().changes_list(
+                    start_date=str(start_date), end_date=str(end_date), page=page
+                )
             else:
-                movies = await route.Show().changes(page=page)
+                movies = await Show().changes_list(
+                    start_date=str(start_date), end_date=str(end_date), page=page
+                )
 
             if not isinstance(movies, dict):
                 # TODO: Noti
                 return 0
 
-            sleep(CONFIG.WAIT_BETWEEN_TMDB_REQUEST)
-
             total_pages = movies.get("total_pages", 0)
             results = movies.get("results", [])
-
-            for result in results:
-                movie_id = result.get("id", 0)
-                if not movie_id:
-                    continue
-
-                await self.crawl_movie_by_id(
-                    movie_id, movie_type=CONFIG.TYPE_TV_SHOWS, movie_on="Other"
+            if CHANGES_KNOWN_ONLY:
+                results = [
+                    result
+                    for result in results
+                    if self._soap2day.is_known_movie(result.get("id", 0), movie_type)
+                ]
+
+            with force_revalidation():
+                failed_ids.extend(
+                    await self.crawl_results(
+                        results, movie_type=movie_type, movie_on="Other"
+                    )
                 )
 
             page += 1
             if page > total_pages:
                 break
+
+        # Titles that failed are retried on the next run instead of holding
+        # the watermark back
+        set_watermark(
+            movie_type,
+            start_date=str(start_date),
+            end_date=str(end_date),
+            retry_ids=failed_ids,
+        )
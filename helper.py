@@ -1,16 +1,21 @@
 from datetime import datetime, timedelta
 from pathlib import Path
-from time import sleep
 
 import requests
 from bs4 import BeautifulSoup
 from slugify import slugify
 
+from _cache import LRUCache
 from _db import Database
 from settings import CONFIG
 
 database = Database()
 
+TERM_CACHE_SIZE = getattr(CONFIG, "TERM_CACHE_SIZE", 20000)
+
+# (taxonomy, formatted term name) -> term_taxonomy_id
+term_cache = LRUCache(maxsize=TERM_CACHE_SIZE)
+
 
 class Helper:
     def get_header(self):
@@ -317,37 +322,114 @@ class Helper:
     def format_condition_str(self, equal_condition: str) -> str:
         return equal_condition.replace("\n", "").strip().lower()
 
-    def insert_terms(self, post_id: int, terms: list, taxonomy: str):
-        for term in terms:
-            term_name = self.format_condition_str(term)
-            cols = "tt.term_taxonomy_id"
-            table = (
-                f"{CONFIG.TABLE_PREFIX}term_taxonomy tt, {CONFIG.TABLE_PREFIX}terms t"
-            )
-            condition = f't.name = "{term_name}" AND tt.term_id=t.term_id AND tt.taxonomy="{taxonomy}"'
+    def select_term_taxonomy_ids(self, keys: list) -> dict:
+        names = list({name for _, name in keys})
+        taxonomies = list({taxonomy for taxonomy, _ in keys})
+        if not names:
+            return {}
+
+        be_terms = database.select_all_from(
+            table=f"{CONFIG.TABLE_PREFIX}term_taxonomy tt, {CONFIG.TABLE_PREFIX}terms t",
+            condition=(
+                f"tt.term_id=t.term_id"
+                f" AND t.name IN ({', '.join(['%s'] * len(names))})"
+                f" AND tt.taxonomy IN ({', '.join(['%s'] * len(taxonomies))})"
+            ),
+            cols="t.name, tt.taxonomy, tt.term_taxonomy_id",
+            data=tuple(names + taxonomies),
+        )
+
+        # The IN lists match every name under every taxonomy; keep only the
+        # (taxonomy, name) pairs that were asked for
+        wanted = set(keys)
+        res = {}
+        for name, taxonomy, term_taxonomy_id in be_terms:
+            key = (taxonomy, self.format_condition_str(name))
+            if key not in wanted:
+                continue
+            res.setdefault(key, term_taxonomy_id)
+            term_cache.put(key, res[key])
+
+        return res
+
+    def insert_missing_terms(self, missing_terms: dict) -> None:
+        # missing_terms: (taxonomy, term name) -> term as it should be stored
+        database.insert_into(
+            table=f"{CONFIG.TABLE_PREFIX}terms",
+            data=[(term, slugify(term), 0) for term in missing_terms.values()],
+            is_bulk=True,
+        )
+
+        slugs = list({slugify(term) for term in missing_terms.values()})
+        orphan_terms = database.select_all_from(
+            table=(
+                f"{CONFIG.TABLE_PREFIX}terms t LEFT JOIN "
+                f"{CONFIG.TABLE_PREFIX}term_taxonomy tt ON tt.term_id=t.term_id"
+            ),
+            condition=(
+                f"tt.term_id IS NULL AND t.slug IN ({', '.join(['%s'] * len(slugs))})"
+                " ORDER BY t.term_id"
+            ),
+            cols="t.term_id, t.slug",
+            data=tuple(slugs),
+        )
+
+        term_ids_by_slug = {}
+        for term_id, slug in orphan_terms:
+            term_ids_by_slug.setdefault(slug, []).append(term_id)
 
-            be_term = database.select_all_from(
-                table=table, condition=condition, cols=cols
+        term_taxonomy_data = []
+        for (taxonomy, _), term in missing_terms.items():
+            term_ids = term_ids_by_slug.get(slugify(term), [])
+            if term_ids:
+                term_taxonomy_data.append((term_ids.pop(0), taxonomy, "", 0, 0))
+
+        if term_taxonomy_data:
+            database.insert_into(
+                table=f"{CONFIG.TABLE_PREFIX}term_taxonomy",
+                data=term_taxonomy_data,
+                is_bulk=True,
             )
-            if not be_term:
-                term_id = database.insert_into(
-                    table=f"{CONFIG.TABLE_PREFIX}terms",
-                    data=(term, slugify(term), 0),
-                )
-                term_taxonomy_id = database.insert_into(
-                    table=f"{CONFIG.TABLE_PREFIX}term_taxonomy",
-                    data=(term_id, taxonomy, "", 0, 0),
-                )
-            else:
-                term_taxonomy_id = be_term[0][0]
 
-            try:
-                database.insert_into(
-                    table=f"{CONFIG.TABLE_PREFIX}term_relationships",
-                    data=(post_id, term_taxonomy_id, 0),
+    def insert_post_terms(self, post_id: int, post_data: dict):
+        terms = {}
+        for taxonomy in CONFIG.TAXONOMIES:
+            if taxonomy in post_data.keys() and post_data[taxonomy]:
+                for term in post_data[taxonomy]:
+                    terms.setdefault((taxonomy, self.format_condition_str(term)), term)
+
+        term_taxonomy_ids = {}
+        for key in terms.keys():
+            term_taxonomy_id = term_cache.get(key)
+            if term_taxonomy_id is not None:
+                term_taxonomy_ids[key] = term_taxonomy_id
+
+        missing_keys = [key for key in terms.keys() if key not in term_taxonomy_ids]
+        if missing_keys:
+            term_taxonomy_ids.update(self.select_term_taxonomy_ids(missing_keys))
+
+            missing_terms = {
+                key: terms[key] for key in missing_keys if key not in term_taxonomy_ids
+            }
+            if missing_terms:
+                self.insert_missing_terms(missing_terms)
+                term_taxonomy_ids.update(
+                    self.select_term_taxonomy_ids(list(missing_terms.keys()))
                 )
-            except:
-                pass
+
+        if term_taxonomy_ids:
+            database.insert_into(
+                table=f"{CONFIG.TABLE_PREFIX}term_relationships",
+                data=[
+                    (post_id, term_taxonomy_id, 0)
+                    for term_taxonomy_id in set(term_taxonomy_ids.values())
+                ],
+                is_bulk=True,
+                ignore=True,
+            )
+
+    def insert_terms(self, post_id: int, terms: list, taxonomy: str):
+        self.insert_post_terms(post_id=post_id, post_data={taxonomy: terms})
 
     def generate_post(self, post_data: dict) -> tuple:
         timeupdate = self.get_timeupdate()
@@ -444,28 +526,24 @@ class Helper:
 
             self.insert_postmeta(postmeta_data)
 
-            for taxonomy in CONFIG.TAXONOMIES:
-                if taxonomy in post_data.keys() and post_data[taxonomy]:
-                    self.insert_terms(
-                        post_id=post_id, terms=post_data[taxonomy], taxonomy=taxonomy
-                    )
+            self.insert_post_terms(post_id=post_id, post_data=post_data)
 
             return post_id
         except Exception as e:
             self.error_log(f"Failed to insert film\n{e}")
 
     def update_meta_key(self, post_id, meta_key, update_value, field) -> list:
-        condition = f'post_id={post_id} AND meta_key="{meta_key}"'
+        where = {"post_id": post_id, "meta_key": meta_key}
         post_temporadas_episodios = database.select_all_from(
-            table=f"{CONFIG.TABLE_PREFIX}postmeta", condition=condition
+            table=f"{CONFIG.TABLE_PREFIX}postmeta", where=where
         )
         if post_temporadas_episodios:
             value = int(post_temporadas_episodios[0][-1])
             if value < update_value:
                 database.update_table(
                     table=f"{CONFIG.TABLE_PREFIX}postmeta",
-                    set_cond=f"meta_value={update_value}",
-                    where_cond=condition,
+                    values={"meta_value": update_value},
+                    where=where,
                 )
             return []
         else:
@@ -571,22 +649,17 @@ class Helper:
             )
         )
 
-        for row in postmeta_data:
-            database.insert_into(
-                table=f"{CONFIG.TABLE_PREFIX}postmeta",
-                data=row,
-            )
-            sleep(0.01)
-
-        sleep(0.01)
+        self.insert_postmeta(postmeta_data)
 
     def insert_postmeta(self, postmeta_data):
-        for row in postmeta_data:
-            database.insert_into(
-                table=f"{CONFIG.TABLE_PREFIX}postmeta",
-                data=row,
-            )
-            sleep(0.01)
+        if not postmeta_data:
+            return
+
+        database.insert_into(
+            table=f"{CONFIG.TABLE_PREFIX}postmeta",
+            data=postmeta_data,
+            is_bulk=True,
+        )
 
 
 helper = Helper()
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import re
@@ -7,16 +8,129 @@ from pathlib import Path
 import requests
 from slugify import slugify
 
+from _cache import KnownIds, LRUCache
 from _db import Database
+from _schema import ensure_crawl_tables, get_upsert_tables
 from helper import helper
 from settings import CONFIG
 
 logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
 
+SLUG_CACHE_SIZE = getattr(CONFIG, "SLUG_CACHE_SIZE", 5000)
+SLUG_TABLES = ("genres", "country")
+
+# (table, slug) -> row, shared by every Soap2day in the process
+slug_cache = LRUCache(maxsize=SLUG_CACHE_SIZE)
+# TMDB ids of every title we host, per movie type
+known_ids = KnownIds()
+
+# Seconds before a crawled title is due again; ended shows use the movie TTL
+CRAWL_TTLS = {
+    CONFIG.TYPE_MOVIE: 7 * 24 * 60 * 60,
+    CONFIG.TYPE_TV_SHOWS: 24 * 60 * 60,
+    **getattr(CONFIG, "CRAWL_TTLS", {}),
+}
+ENDED_STATUSES = ("Ended", "Canceled")
+
+# TMDB fields that end up in the movie row; a title is rewritten only when
+# one of them changes
+FINGERPRINT_KEYS = (
+    "id",
+    "title",
+    "original_title",
+    "original_name",
+    "poster_path",
+    "backdrop_path",
+    "release_date",
+    "last_air_date",
+    "runtime",
+    "episode_run_time",
+    "vote_average",
+    "vote_count",
+    "overview",
+    "status",
+    "casts",
+    "directors",
+    "keywords",
+    "trailer_id",
+    "number_of_episodes",
+)
+# Columns owned by the site (counters, curation) or set only at insert, which
+# a re-crawl must not reset
+MOVIE_PRESERVED_COLUMNS = (
+    "view",
+    "view_day",
+    "view_week",
+    "view_month",
+    "quality",
+    "hot",
+    "onSlider",
+    "public",
+    "slug",
+    "type",
+    "count_fav",
+    "player_fake",
+    "movieOn",
+    "creater",
+)
+
 
 class Soap2day:
+    _slug_cache_loaded = False
+    _crawl_tables_ready = False
+    _known_ids_loaded = False
+    # Highest movie.id already in known_ids; reloads only read newer rows
+    _known_max_id = 0
+    # Tables that have the unique key upsert dedupes on, checked once
+    _upsert_tables = None
+
     def __init__(self, database: Database):
         self._database = database
+        if not Soap2day._slug_cache_loaded:
+            self.preload_slug_cache()
+        if not Soap2day._crawl_tables_ready:
+            ensure_crawl_tables(self._database)
+            Soap2day._crawl_tables_ready = True
+        if Soap2day._upsert_tables is None:
+            self.load_upsert_tables()
+        if not Soap2day._known_ids_loaded:
+            self.load_known_ids()
+
+    def load_upsert_tables(self) -> None:
+        try:
+            Soap2day._upsert_tables = get_upsert_tables(self._database)
+        except Exception as e:
+            Soap2day._upsert_tables = set()
+            helper.error_log(
+                f"Failed to inspect unique keys\n{e}",
+                "soap2day.load_upsert_tables.log",
+            )
+
+        missing = {"movie", "season", "episode", *SLUG_TABLES} - Soap2day._upsert_tables
+        if missing:
+            logging.warning(
+                f"No unique lookup key on {', '.join(sorted(missing))};"
+                " run _migrate.py --apply. Using select-then-insert for them."
+            )
+
+    def get_or_insert_id(self, table: str, data: tuple, where: dict) -> int:
+        # Without the unique key an upsert would insert a duplicate row
+        if table in Soap2day._upsert_tables:
+            return self._database.upsert(table=table, data=data)
+        row = self._database.select_or_insert(table=table, data=data, where=where)[0]
+        return row[0]
+
+    def preload_slug_cache(self) -> None:
+        try:
+            for table in SLUG_TABLES:
+                for row in self._database.select_all_from(table=table):
+                    slug_cache.put((table, row[-1]), row)
+            Soap2day._slug_cache_loaded = True
+        except Exception as e:
+            helper.error_log(
+                f"Failed to preload slug cache\n{e}",
+                "soap2day.preload_slug_cache.log",
+            )
 
     def get_header(self):
         header = {
@@ -127,14 +241,21 @@ class Soap2day:
         res = []
         for name in names[: CONFIG.MAX_CASTS_LENGTH]:
             try:
-                condition = f"slug='{slugify(name)}'"
-                data = (name, slugify(name))
-                be_data_with_slug = self._database.select_or_insert(
-                    table=table, condition=condition, data=data
-                )
-                res.append(be_data_with_slug[0][-1])
+                slug = slugify(name)
+                be_data_with_slug = slug_cache.get((table, slug))
+                if be_data_with_slug is None:
+                    data = (name, slug)
+                    be_data_with_slug = (
+                        self.get_or_insert_id(table, data=data, where={"slug": slug}),
+                        *data,
+                    )
+                    slug_cache.put((table, slug), be_data_with_slug)
+                res.append(be_data_with_slug[-1])
             except:
-                pass
+                # Under a transaction the whole title rolls back instead of
+                # being committed without this row
+                if self._database.in_transaction():
+                    raise
 
         if table == "country":
             if len(names) > 0:
@@ -144,6 +265,53 @@ class Soap2day:
 
         return json.dumps(res)
 
+    def load_known_ids(self) -> None:
+        # Cheap to call again: titles other processes added since the last
+        # call are merged into the set
+        try:
+            ids = {}
+            max_id = Soap2day._known_max_id
+            # Slugs are "<tmdb id>-<title>", which also covers titles crawled
+            # before crawl_index existed
+            for movie_id, movie_type, slug in self._database.select_all_from(
+                table="movie",
+                condition="id > %s",
+                cols="id, type, slug",
+                data=(Soap2day._known_max_id,),
+            ):
+                max_id = max(max_id, movie_id)
+                match = re.match(r"(\d+)-", slug or "")
+                if match:
+                    ids.setdefault(movie_type, []).append(int(match.group(1)))
+            for tmdb_id, movie_type in self._database.select_all_from(
+                table="crawl_index",
+                condition="movie_id > %s",
+                cols="tmdb_id, type",
+                data=(Soap2day._known_max_id,),
+            ):
+                ids.setdefault(movie_type, []).append(tmdb_id)
+
+            for movie_type, tmdb_ids in ids.items():
+                if Soap2day._known_ids_loaded:
+                    known_ids.update(movie_type, tmdb_ids)
+                else:
+                    known_ids.load(movie_type, tmdb_ids)
+                logging.info(f"Loaded {len(tmdb_ids)} known {movie_type} TMDB IDs")
+            Soap2day._known_max_id = max_id
+            Soap2day._known_ids_loaded = True
+        except Exception as e:
+            helper.error_log(
+                f"Failed to load known TMDB IDs\n{e}",
+                "soap2day.load_known_ids.log",
+            )
+
+    def is_known_movie(self, tmdb_id: int, movie_type: str) -> bool:
+        if not Soap2day._known_ids_loaded:
+            # Without the index, every title counts as known
+            return True
+
+        return known_ids.contains(movie_type, tmdb_id)
+
     def get_year_from(self, released: str) -> int:
         try:
             dt = datetime.strptime(released, "%Y-%m-%d")
@@ -170,6 +338,136 @@ class Soap2day:
 
         return str(episode_run_time)
 
+    def get_movie_fingerprint(self, movie_data: dict) -> str:
+        payload = {key: movie_data.get(key) for key in FINGERPRINT_KEYS}
+        payload["genres"] = sorted(
+            genre.get("name", "") for genre in movie_data.get("genres", [])
+        )
+        payload["countries"] = sorted(
+            country.get("name", "")
+            for country in movie_data.get("production_countries", [])
+        )
+        payload["seasons"] = [
+            [
+                season.get("season_number"),
+                season.get("episode_count"),
+                season.get("air_date"),
+            ]
+            for season in movie_data.get("seasons", [])
+        ]
+        for key in ("last_episode_to_air", "next_episode_to_air"):
+            episode = movie_data.get(key)
+            payload[key] = episode.get("id") if isinstance(episode, dict) else None
+
+        return hashlib.sha1(
+            json.dumps(payload, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def get_indexed_movie(self, tmdb_id: int, movie_type: str) -> tuple:
+        be_index = self._database.select_all_from(
+            table="crawl_index",
+            cols="movie_id, fingerprint",
+            where={"tmdb_id": tmdb_id, "type": movie_type},
+        )
+        return be_index[0] if be_index else None
+
+    def get_episode_counts(self, tmdb_id: int, movie_type: str) -> dict:
+        # Stored episodes per season number for a title we already crawled
+        indexed = self.get_indexed_movie(tmdb_id, movie_type)
+        if not indexed:
+            return {}
+
+        return {
+            int(num): count
+            for num, count in self._database.select_with(
+                f"SELECT s.num, COUNT(e.id) FROM {CONFIG.TABLE_PREFIX}season s"
+                f" LEFT JOIN {CONFIG.TABLE_PREFIX}episode e"
+                " ON e.movieId=s.movieId AND e.seasonId=s.id"
+                " WHERE s.movieId=%s GROUP BY s.num",
+                (indexed[0],),
+            )
+        }
+
+    def get_unchanged_movie_id(self, movie_data: dict, movie_type: str) -> int:
+        indexed = self.get_indexed_movie(movie_data.get("id", 0), movie_type)
+        if indexed and indexed[1] == self.get_movie_fingerprint(movie_data):
+            return indexed[0]
+
+        return 0
+
+    def get_crawl_ttl(self, movie_data: dict, movie_type: str) -> int:
+        if movie_data.get("status") in ENDED_STATUSES:
+            return CRAWL_TTLS[CONFIG.TYPE_MOVIE]
+
+        return CRAWL_TTLS.get(movie_type, CRAWL_TTLS[CONFIG.TYPE_MOVIE])
+
+    def mark_movie_crawled(
+        self, movie_data: dict, movie_type: str, movie_id: int
+    ) -> None:
+        self._database.execute(
+            f"""INSERT INTO {CONFIG.TABLE_PREFIX}crawl_index
+            (tmdb_id, type, movie_id, fingerprint, last_crawled_at, next_due_at)
+            VALUES (%s, %s, %s, %s, NOW(), NOW() + INTERVAL %s SECOND)
+            ON DUPLICATE KEY UPDATE
+            movie_id=VALUES(movie_id), fingerprint=VALUES(fingerprint),
+            last_crawled_at=VALUES(last_crawled_at), next_due_at=VALUES(next_due_at)""",
+            (
+                movie_data.get("id", 0),
+                movie_type,
+                movie_id,
+                self.get_movie_fingerprint(movie_data),
+                self.get_crawl_ttl(movie_data, movie_type),
+            ),
+        )
+
+    def get_fresh_tmdb_ids(self, tmdb_ids: list, movie_type: str) -> set:
+        if not tmdb_ids:
+            return set()
+
+        return {
+            tmdb_id
+            for tmdb_id, in self._database.select_all_from(
+                table="crawl_index",
+                condition=(
+                    f"type=%s AND next_due_at > NOW()"
+                    f" AND tmdb_id IN ({', '.join(['%s'] * len(tmdb_ids))})"
+                ),
+                cols="tmdb_id",
+                data=(movie_type, *tmdb_ids),
+            )
+        }
+
+    def is_same_value(self, be_value, value) -> bool:
+        if isinstance(be_value, bytes):
+            be_value = be_value.decode()
+        try:
+            return float(be_value) == float(value)
+        except (TypeError, ValueError):
+            return str(be_value) == str(value)
+
+    def update_movie(self, movie_id: int, be_movie: tuple, movie: dict) -> None:
+        changed = {
+            column: value
+            for column, be_value, value in zip(
+                CONFIG.INSERT["movie"], be_movie, movie.values()
+            )
+            if column not in MOVIE_PRESERVED_COLUMNS
+            and column != "time"
+            and not self.is_same_value(be_value, value)
+        }
+        if not changed:
+            return
+
+        changed["time"] = movie["time"]
+        self._database.update_table(
+            table="movie",
+            values=changed,
+            where={"id": movie_id},
+        )
+        logging.info(
+            f"Updated movie ID: {movie_id} columns: {', '.join(changed.keys())}"
+        )
+
     def insert_movie(self, movie_data: dict, movie_type: str) -> int:
         try:
             timeupdate = self.get_timeupdate()
@@ -238,10 +536,22 @@ class Soap2day:
                 "creater": timeupdate.strftime("%Y-%m-%d"),
             }
 
-            condition = f"""slug='{movie.get("slug")}' AND type='{movie_type}'"""
-            post_id = self._database.select_or_insert(
-                table="movie", condition=condition, data=list(movie.values())
-            )[0][0]
+            be_movie = self._database.select_all_from(
+                table="movie",
+                where={"slug": movie.get("slug"), "type": movie_type},
+                cols=", ".join(["id", *CONFIG.INSERT["movie"]]),
+            )
+            if not be_movie:
+                post_id = self.get_or_insert_id(
+                    "movie",
+                    data=list(movie.values()),
+                    where={"slug": movie.get("slug"), "type": movie_type},
+                )
+                known_ids.add(movie_type, movie_data.get("id", 0))
+                return post_id
+
+            post_id = be_movie[0][0]
+            self.update_movie(post_id, be_movie[0][1:], movie)
 
             return post_id
         except Exception as e:
@@ -249,13 +559,15 @@ class Soap2day:
                 f'Failed to insert film: {movie_data.get("title", "")}\n{e}',
                 "hdtoday.insert_movie.log",
             )
+            if self._database.in_transaction():
+                raise
             return 0
 
     def insert_root_film(self) -> list:
-        condition = (
-            f"""slug = '{self.film["slug"]}' AND type='{self.film["post_type"]}'"""
+        be_post = self._database.select_all_from(
+            table="movie",
+            where={"slug": self.film["slug"], "type": self.film["post_type"]},
         )
-        be_post = self._database.select_all_from(table=f"movie", condition=condition)
         if not be_post:
             logging.info(f'Inserting root film: {self.film["post_title"]}')
             post_data = self.generate_film_data(
@@ -326,111 +638,77 @@ class Soap2day:
 
         return "1"
 
-    def get_episode_data(self) -> list:
-        res = []
-        episodes = {}
-        for server_data in self.episodes.values():
-            server_episodes = server_data.get("episodes", {})
-            for ep_name, ep_link in server_episodes.items():
-                if not ep_link.startswith("https"):
-                    ep_link = "https:" + ep_link
-
-                episodes.setdefault(ep_name, [])
-                episodes[ep_name].append(ep_link)
-
-        for ep_name, ep_links in episodes.items():
-            ep_links = sorted(list(set(ep_links)))
-            episodes[ep_name] = ep_links
-
-        for ep_name, ep_links in episodes.items():
-            if self.film["post_type"] == CONFIG.TYPE_MOVIE:
-                episode_name = f""
-                episode_number = "1"
-            else:
-                episode_name = ep_name
-                episode_number = self.get_ep_num_from(ep_name)
-
-            res.append(
-                {
-                    "ep_name": episode_name,
-                    "ep_num": episode_number,
-                    "ep_time": 0,
-                    "episode_server": self.get_episode_server_from(ep_links),
-                }
-            )
-
-        return res
-
-    def insert_episodes(self, movie_id: int) -> None:
-        logging.info(
-            f"Updating episodes for movie {self.film['post_title']} with ID: {movie_id}"
-        )
-
-        # if self.film["post_type"] == CONFIG.TYPE_MOVIE:
-        #     self.episodes["Season 1"] = {
-        #         "1": "Episode 1",
-        #     }
-
-        self.film["season_number"] = self.get_season_number()
-
-        data = [
-            {
-                "season_name": self.film["season_number"],
-                "episode_list": self.get_episode_data(),
+    def get_or_insert_seasons(self, movie_id: int, seasons: list) -> dict:
+        try:
+            season_ids = {
+                int(num): season_id
+                for season_id, num in self._database.select_all_from(
+                    table="season", cols="id, num", where={"movieId": movie_id}
+                )
             }
-        ]
-
-        # for key, value in self.episodes.items():
-        #     if "season" in key.lower():
-        #         data.append(
-        #             {
-        #                 "season_name": key,
-        #                 "episode_list": self.get_episode_data(season_episodes=value),
-        #             }
-        #         )
 
-        data = json.dumps(data)
+            data = [
+                (season_number, movie_id, season_name)
+                for season_number, season_name in seasons
+                if season_number and int(season_number) not in season_ids
+            ]
+            if data:
+                self._database.insert_into(
+                    table="season", data=data, is_bulk=True, ignore=True
+                )
+                season_ids = {
+                    int(num): season_id
+                    for season_id, num in self._database.select_all_from(
+                        table="season", cols="id, num", where={"movieId": movie_id}
+                    )
+                }
+                logging.info(f"Inserted {len(data)} seasons <= Movie ID: {movie_id}")
 
-        be_episode_data = self._database.select_or_insert(
-            table="episode", condition=f"movie_id={movie_id}", data=(movie_id, data)
-        )
+            return season_ids
+        except Exception as e:
+            helper.error_log(
+                f"Failed to insert seasons for movie ID: {movie_id}\n{e}",
+                "soap2day.get_or_insert_seasons.log",
+            )
+            if self._database.in_transaction():
+                raise
+            return {}
 
-        episode_data = be_episode_data[0][2]
-        episode_data = (
-            episode_data.decode() if isinstance(episode_data, bytes) else episode_data
-        )
-        # with open("json/diff.txt", "w") as f:
-        #     print(data, file=f)
-        #     print(episode_data, file=f)
-
-        if episode_data != data:
-            print("Diff")
-            escape_data = data.replace("'", "''")
-            self._database.update_table(
+    def get_or_insert_episodes(
+        self, movie_id: int, season_id: int, episodes: list, thumb_url: str
+    ) -> None:
+        be_episode_numbers = {
+            int(num)
+            for num, in self._database.select_all_from(
                 table="episode",
-                set_cond=f"""data='{escape_data}'""",
-                where_cond=f"movie_id={movie_id}",
+                where={"movieId": movie_id, "seasonId": season_id},
+                cols="num",
             )
+        }
 
-    def get_or_insert_season(
-        self, movie_id: int, season_number: int, season_name: str
-    ) -> int:
-        try:
-            condition = f"""num={season_number} AND movieId={movie_id}"""
-            data = (season_number, movie_id, season_name)
-            season = self._database.select_or_insert(
-                table="season", condition=condition, data=data
+        data = []
+        for episode, episode_data in episodes:
+            episode_number = episode.get("episode_number", 0)
+            if not episode_number or int(episode_number) in be_episode_numbers:
+                continue
+
+            be_episode_numbers.add(int(episode_number))
+            data.append(
+                (
+                    movie_id,
+                    episode_number,
+                    season_id,
+                    thumb_url,
+                    episode.get("name", ""),
+                    json.dumps(episode_data),
+                )
             )
 
-            season_id = season[0][0]
-            logging.info(
-                f"Got or inserted season ID: {season_id} <= Movie ID: {movie_id}\tSeason name: {season_name}"
+        if data:
+            self._database.insert_into(
+                table="episode", data=data, is_bulk=True, ignore=True
             )
 
-            return season_id
-        except:
-            return 0
-
     def get_or_insert_episode(
         self,
         movie_id: int,
@@ -446,10 +724,6 @@ class Soap2day:
         if not episode_number:
             return
 
-        condition = (
-            f"""movieId={movie_id} AND seasonId={season_id} AND num={episode_number}"""
-        )
-
         data = (
             movie_id,
             episode_number,
@@ -459,4 +733,8 @@ class Soap2day:
             json.dumps(episode_data),
         )
 
-        self._database.select_or_insert(table="episode", condition=condition, data=data)
+        self.get_or_insert_id(
+            "episode",
+            data=data,
+            where={"movieId": movie_id, "seasonId": season_id, "num": episode_number},
+        )